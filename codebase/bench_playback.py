@@ -0,0 +1,120 @@
+"""Сравнение нагрузки на CPU в режимах воспроизведения PCM и Opus.
+
+PCM:  ffmpeg отдаёт сырой PCM, каждый 20 мс кадр кодируется в Opus внутри процесса Python.
+Opus: ffmpeg сам кодирует поток в Opus, Python лишь читает готовые пакеты.
+
+Запуск:
+    python3 bench_playback.py [station] --seconds 30 --bitrate 128
+
+Время CPU считается по процессу бота и дочерним ffmpeg (getrusage) и делится на длительность
+полученного аудио, поэтому результат не зависит от того, как быстро отдаёт данные сервер.
+Число потоков на ядро — экстраполяция с одного потока, одновременные потоки не запускаются.
+"""
+import argparse
+import ctypes.util
+import resource
+import time
+
+import discord
+from discord.opus import Encoder
+
+from main import FFMPEG_OPTIONS, STATION_NAMES, STATION_URLS, DEFAULT_OPUS_BITRATE
+
+FRAME_SECONDS = Encoder.FRAME_LENGTH / 1000
+
+
+def _cpu_seconds() -> tuple[float, float]:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+def run_pcm(url: str, frames: int, bitrate: int) -> tuple[int, float, float]:
+    encoder = Encoder()
+    encoder.set_bitrate(bitrate)
+    source = discord.FFmpegPCMAudio(url, **FFMPEG_OPTIONS)
+    own_start, children_start = _cpu_seconds()
+    played = 0
+    try:
+        while played < frames:
+            pcm = source.read()
+            if not pcm:
+                break
+            encoder.encode(pcm, Encoder.SAMPLES_PER_FRAME)
+            played += 1
+    finally:
+        # cleanup() дожидается ffmpeg, после чего его время попадает в RUSAGE_CHILDREN
+        source.cleanup()
+    own_end, children_end = _cpu_seconds()
+    return played, own_end - own_start, children_end - children_start
+
+
+def run_opus(url: str, frames: int, bitrate: int) -> tuple[int, float, float]:
+    source = discord.FFmpegOpusAudio(url, bitrate=bitrate, **FFMPEG_OPTIONS)
+    own_start, children_start = _cpu_seconds()
+    played = 0
+    try:
+        while played < frames:
+            packet = source.read()
+            if not packet:
+                break
+            played += 1
+    finally:
+        source.cleanup()
+    own_end, children_end = _cpu_seconds()
+    return played, own_end - own_start, children_end - children_start
+
+
+def load_opus(library: str | None):
+    if discord.opus.is_loaded():
+        return
+    library = library or ctypes.util.find_library("opus")
+    if not library:
+        raise SystemExit("libopus не найдена: установите libopus или укажите путь через --opus-lib")
+    try:
+        discord.opus.load_opus(library)
+    except OSError as e:
+        raise SystemExit(f"Не удалось загрузить libopus ({library}): {e}")
+
+
+def report(mode: str, played: int, own: float, children: float):
+    audio_seconds = played * FRAME_SECONDS
+    if audio_seconds <= 0:
+        print(f"{mode}: поток не вернул ни одного кадра")
+        return
+    total = own + children
+    share = total / audio_seconds
+    streams_per_core = 1 / share if share > 0 else float("inf")
+    print(
+        f"{mode}: аудио {audio_seconds:.1f} с | CPU бота {own:.2f} с, ffmpeg {children:.2f} с | "
+        f"{share * 100:.2f}% ядра на поток | ~{streams_per_core:.0f} потоков на ядро (экстраполяция) | "
+        f"в процессе бота: {own / audio_seconds * 100:.2f}% ядра на поток"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк режимов воспроизведения PCM и Opus")
+    parser.add_argument("station", nargs="?", default="record", help="станция из списка или URL потока")
+    parser.add_argument("--seconds", type=float, default=30, help="длительность аудио на каждый режим")
+    parser.add_argument("--bitrate", type=int, default=DEFAULT_OPUS_BITRATE, help="битрейт Opus, кбит/с")
+    parser.add_argument("--opus-lib", help="путь к libopus для режима PCM (по умолчанию ищется в системе)")
+    args = parser.parse_args()
+
+    if args.station in STATION_URLS:
+        url = STATION_URLS[args.station]
+    elif "://" in args.station:
+        url = args.station
+    else:
+        parser.error(f"неизвестная станция: {args.station}. Доступные: {', '.join(STATION_NAMES)}")
+
+    load_opus(args.opus_lib)
+    frames = int(args.seconds / FRAME_SECONDS)
+    for mode, runner in (("pcm", run_pcm), ("opus", run_opus)):
+        started = time.perf_counter()
+        report(mode, *runner(url, frames, args.bitrate))
+        print(f"    (заняло {time.perf_counter() - started:.1f} с реального времени)")
+    print("Потоки на ядро рассчитаны как 1 / (доля ядра на один поток) — одновременные потоки не измерялись.")
+
+
+if __name__ == "__main__":
+    main()
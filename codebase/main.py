@@ -6,9 +6,19 @@ from dotenv import load_dotenv
 import asyncio
 import aiohttp
 import re
+import threading
+import time
+from collections import deque
 
 load_dotenv()
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
+# "opus" — кодирование в подпроцессе ffmpeg (FFmpegOpusAudio), "pcm" — кодирование в процессе бота
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'opus').lower()
+PLAYBACK_MODES = ("opus", "pcm")
+if PLAYBACK_MODE not in PLAYBACK_MODES:
+    raise SystemExit(f"Неизвестный PLAYBACK_MODE={PLAYBACK_MODE!r}, допустимые значения: {', '.join(PLAYBACK_MODES)}")
+# Размер джиттер-буфера: столько аудио копится перед воспроизведением и после провала
+JITTER_BUFFER_MS = int(os.getenv('JITTER_BUFFER_MS', '1000'))
 
 intents = discord.Intents.default()
 bot = commands.Bot(command_prefix="!", intents=intents)
@@ -141,9 +151,27 @@ RADIO_STATIONS = [
 STATION_NAMES = [name for name, url in RADIO_STATIONS]
 STATION_URLS = dict(RADIO_STATIONS)
 
+FFMPEG_OPTIONS = {
+    "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -fflags +nobuffer -flags low_delay -probesize 32k -analyzeduration 0",
+    "options": "-vn -bufsize 256k"
+}
+DEFAULT_OPUS_BITRATE = 128  # kbps, если битрейт канала неизвестен
+MIN_OPUS_BITRATE = 8
+MAX_OPUS_BITRATE = 510  # верхняя граница libopus
+FRAME_MS = 20  # длительность одного кадра discord.py
+UPSTREAM_CONNECT_GRACE_SECONDS = 2  # столько даём новому ffmpeg на подключение, прежде чем считать его зависшим
+STALL_BUFFER_FRACTION = 0.5  # нет новых кадров дольше этой доли буфера — переподключаемся, пока буфер доигрывается
+RECONNECT_MIN_DELAY_SECONDS = 0.5
+RECONNECT_MAX_DELAY_SECONDS = 5
+MAX_SILENCE_SECONDS = 20  # тишина дольше этого — считаем поток потерянным
+OPUS_SILENCE_FRAME = b"\xf8\xff\xfe"
+PCM_SILENCE_FRAME = b"\x00" * 3840  # 20 мс, 48 кГц, стерео, 16 бит
+
 player_state = {}  # guild_id: {"station_idx": int, "paused": bool}
 guild_locks = {}   # guild_id: asyncio.Lock
 control_messages = {}  # guild_id: {"channel_id": int, "message_id": int, "last_content": str}
+guild_bitrates = {}  # guild_id: int (kbps), переопределяет битрейт голосового канала
+station_stats = {}  # station_name: {"underruns": int, "reconnects": int}
 http_session = None  # type: ignore[assignment]
 track_updater_task = None  # type: ignore[assignment]
 control_refresh_task = None  # type: ignore[assignment]
@@ -423,6 +451,198 @@ async def ensure_voice(interaction):
         await interaction.followup.send(f"Ошибка подключения: {type(e).__name__}: {e}", ephemeral=True)
         return None
 
+def resolve_opus_bitrate(guild_id: int, voice_channel) -> int:
+    """Opus bitrate in kbps: per-guild setting, else the voice channel bitrate."""
+    bitrate = guild_bitrates.get(guild_id)
+    if not bitrate:
+        channel_bitrate = getattr(voice_channel, "bitrate", None)
+        bitrate = channel_bitrate // 1000 if channel_bitrate else DEFAULT_OPUS_BITRATE
+    return max(MIN_OPUS_BITRATE, min(MAX_OPUS_BITRATE, bitrate))
+
+def create_audio_source(guild_id: int, voice_client, radio_url: str) -> discord.AudioSource:
+    if PLAYBACK_MODE == "pcm":
+        return discord.FFmpegPCMAudio(radio_url, **FFMPEG_OPTIONS)
+    # ffmpeg сам кодирует AAC -> Opus, discord.py лишь пересылает готовые пакеты
+    bitrate = resolve_opus_bitrate(guild_id, voice_client.channel)
+    return discord.FFmpegOpusAudio(radio_url, bitrate=bitrate, **FFMPEG_OPTIONS)
+
+def get_station_stats(station_name: str) -> dict:
+    stats = station_stats.get(station_name)
+    if stats is None:
+        stats = {"underruns": 0, "reconnects": 0}
+        station_stats[station_name] = stats
+    return stats
+
+class UpstreamLost(Exception):
+    pass
+
+class BufferedRadioSource(discord.AudioSource):
+    """Jitter buffer in front of an ffmpeg source.
+
+    A reader thread pulls frames from the upstream source into a bounded deque and
+    rebuilds the upstream whenever it ends. read() serves frames from the deque,
+    counts underruns, fills gaps with silence and forces a reconnect on a stall.
+    The reader starts on the first read(), so a source that never gets played holds
+    no thread and is collected like a plain ffmpeg source. Once started, only the
+    reader thread calls cleanup() on upstream sources; other threads just kill the
+    ffmpeg process to unblock it.
+    """
+
+    def __init__(self, source_factory, stats: dict, buffer_ms: int = JITTER_BUFFER_MS, name: str = ""):
+        self._factory = source_factory
+        self._stats = stats
+        self._name = name
+        self._target = max(1, buffer_ms // FRAME_MS)
+        self._stall_timeout = self._target * FRAME_MS / 1000 * STALL_BUFFER_FRACTION
+        # Жёсткий предел памяти; отставание от эфира ограничивает read(), обрезая очередь до target
+        self._frames = deque(maxlen=self._target * 4)
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        # cleanup() из __del__ должен работать, даже если фабрика ниже упала
+        self._source = None
+        self._reader = None
+        # Первый источник создаём сразу, чтобы ошибки запуска ffmpeg дошли до вызывающего
+        self._source = source_factory()
+        self._opus = self._source.is_opus()
+        self._silence = OPUS_SILENCE_FRAME if self._opus else PCM_SILENCE_FRAME
+        self._filling = True
+        self._stalled_since = None
+        self._reconnect_requested = False
+        # Время установки текущего источника: новому ffmpeg даём время подключиться
+        self._reconnected_at = time.monotonic()
+        self._last_frame_at = 0.0  # пишет поток чтения
+        self._last_error = None
+
+    def _start_reader(self):
+        with self._lock:
+            if self._reader is not None or self._closed.is_set():
+                return
+            self._reconnected_at = time.monotonic()
+            self._reader = threading.Thread(target=self._read_upstream, name="radio-buffer", daemon=True)
+            self._reader.start()
+
+    def is_opus(self) -> bool:
+        return self._opus
+
+    def _read_upstream(self):
+        delay = RECONNECT_MIN_DELAY_SECONDS
+        while not self._closed.is_set():
+            source = self._source
+            received = 0
+            try:
+                while not self._closed.is_set():
+                    frame = source.read()
+                    if not frame:
+                        break
+                    self._frames.append(frame)
+                    self._last_frame_at = time.monotonic()
+                    received += 1
+            except Exception as e:
+                self._last_error = f"{type(e).__name__}: {e}"
+                print(f"Upstream read error ({self._name}): {self._last_error}")
+            finally:
+                source.cleanup()
+            if self._closed.is_set():
+                return
+            # Источник оборвался — пересоздаём его, пока read() доигрывает буфер
+            self._stats["reconnects"] += 1
+            if received >= self._target:
+                # Источник успел отыграть целый буфер — начинаем отсчёт пауз заново
+                delay = RECONNECT_MIN_DELAY_SECONDS
+            # Пауза нужна всегда: источник, который отдаёт пару кадров и закрывается, не должен долбить сервер
+            self._closed.wait(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY_SECONDS)
+            while not self._closed.is_set():
+                try:
+                    new_source = self._factory()
+                    break
+                except Exception as e:
+                    self._last_error = f"{type(e).__name__}: {e}"
+                    print(f"Upstream reconnect error ({self._name}): {self._last_error}")
+                    self._closed.wait(delay)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY_SECONDS)
+            else:
+                return
+            with self._lock:
+                self._source = new_source
+                self._reconnected_at = time.monotonic()
+                self._reconnect_requested = False
+            if self._closed.is_set():
+                new_source.cleanup()
+
+    def _kill_upstream(self, source):
+        # Только сигнал процессу: поток чтения разблокируется и сам вызовет cleanup()
+        process = getattr(source, "_process", None)
+        if not process:
+            return
+        try:
+            process.kill()
+        except Exception as e:
+            print(f"Failed to kill upstream ({self._name}): {type(e).__name__}: {e}")
+
+    def _request_reconnect(self):
+        with self._lock:
+            if self._reconnect_requested:
+                return
+            self._reconnect_requested = True
+            source = self._source
+        self._kill_upstream(source)
+
+    def read(self) -> bytes:
+        if self._reader is None:
+            self._start_reader()
+        now = time.monotonic()
+        if (now - self._last_frame_at > self._stall_timeout
+                and now - self._reconnected_at > UPSTREAM_CONNECT_GRACE_SECONDS):
+            # Источник замолчал — пересоздаём его, пока буфер ещё доигрывается
+            self._request_reconnect()
+        if not self._filling and not self._frames:
+            self._stats["underruns"] += 1
+            self._filling = True
+        if self._filling:
+            if len(self._frames) >= self._target:
+                self._filling = False
+            elif self._frames:
+                # Данные идут, буфер просто ещё не набран
+                self._stalled_since = None
+            elif self._stalled_since is None:
+                self._stalled_since = time.monotonic()
+        if not self._filling:
+            self._stalled_since = None
+            if len(self._frames) > self._target * 2:
+                # После паузы или всплеска от сервера скопилось лишнее — возвращаемся ближе к эфиру
+                for _ in range(len(self._frames) - self._target):
+                    self._frames.popleft()
+            return self._frames.popleft()
+        if self._stalled_since is not None and now - self._stalled_since > MAX_SILENCE_SECONDS:
+            reason = f"нет данных от источника {MAX_SILENCE_SECONDS} с"
+            if self._last_error:
+                reason += f" (последняя ошибка: {self._last_error})"
+            raise UpstreamLost(reason)
+        # Короткие провалы заполняем тишиной, чтобы не рвать воспроизведение
+        return self._silence
+
+    def cleanup(self):
+        with self._lock:
+            self._closed.set()
+            source = self._source
+            reader = self._reader
+        if reader is None:
+            # Источник так и не проигрывался — чистим upstream сами
+            if source is not None:
+                source.cleanup()
+            return
+        self._kill_upstream(source)
+        reader.join(timeout=2)
+
+def create_buffered_source(guild_id: int, voice_client, station_idx: int) -> BufferedRadioSource:
+    name, radio_url = RADIO_STATIONS[station_idx]
+    return BufferedRadioSource(
+        lambda: create_audio_source(guild_id, voice_client, radio_url),
+        get_station_stats(name),
+        name=name,
+    )
+
 async def start_radio(interaction, station_idx):
     guild_id = interaction.guild.id
     name, radio_url = RADIO_STATIONS[station_idx]
@@ -435,19 +655,19 @@ async def start_radio(interaction, station_idx):
 
         if voice_client.is_playing() or voice_client.is_paused():
             voice_client.stop()
-        ffmpeg_options = {
-            "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -fflags +nobuffer -flags low_delay -probesize 32k -analyzeduration 0",
-            "options": "-vn -bufsize 256k"
-        }
+        source = None
         try:
-            source = discord.FFmpegPCMAudio(radio_url, **ffmpeg_options)
+            source = create_buffered_source(guild_id, voice_client, station_idx)
 
             def after_playback(error):
                 if error:
                     bot.loop.call_soon_threadsafe(asyncio.create_task, interaction.followup.send(f"Поток прерван: {error}", ephemeral=True))
 
-            voice_client.play(source, after=after_playback)
+            # В режиме PCM битрейт применяет встроенный кодировщик discord.py, для Opus он уже задан в ffmpeg
+            voice_client.play(source, after=after_playback, bitrate=resolve_opus_bitrate(guild_id, voice_client.channel))
         except Exception as e:
+            if source is not None:
+                source.cleanup()
             await interaction.followup.send(f"Не удалось запустить поток: {type(e).__name__}: {e}", ephemeral=True)
             return
         # Удаляем предыдущее сообщение управления, если было
@@ -479,14 +699,13 @@ async def switch_radio(interaction, direction):
     async with get_guild_lock(guild_id):
         if voice_client.is_playing() or voice_client.is_paused():
             voice_client.stop()
-        ffmpeg_options = {
-            "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -fflags +nobuffer -flags low_delay -probesize 32k -analyzeduration 0",
-            "options": "-vn -bufsize 256k"
-        }
+        source = None
         try:
-            source = discord.FFmpegPCMAudio(radio_url, **ffmpeg_options)
-            voice_client.play(source)
+            source = create_buffered_source(guild_id, voice_client, idx)
+            voice_client.play(source, bitrate=resolve_opus_bitrate(guild_id, voice_client.channel))
         except Exception as e:
+            if source is not None:
+                source.cleanup()
             ref = control_messages.get(guild_id)
             target_id = ref["message_id"] if ref else interaction.message.id
             await interaction.followup.edit_message(message_id=target_id, content=f"Не удалось запустить поток: {type(e).__name__}: {e}", view=None)
@@ -628,6 +847,37 @@ async def station_autocomplete(interaction: discord.Interaction, current: str):
         print("Autocomplete error:", e)
         return []
 
+@bot.tree.command(name="bitrate", description="Задать битрейт Opus для сервера (0 — как у голосового канала)")
+@app_commands.default_permissions(manage_guild=True)
+@app_commands.guild_only()
+@app_commands.describe(kbps=f"Битрейт в кбит/с ({MIN_OPUS_BITRATE}-{MAX_OPUS_BITRATE}), 0 — битрейт канала")
+async def set_bitrate(interaction: discord.Interaction, kbps: int = 0):
+    await interaction.response.defer(ephemeral=True)
+    guild_id = interaction.guild.id
+    if kbps == 0:
+        guild_bitrates.pop(guild_id, None)
+        await interaction.followup.send("🎚️ Битрейт будет соответствовать голосовому каналу.", ephemeral=True)
+        return
+    if not MIN_OPUS_BITRATE <= kbps <= MAX_OPUS_BITRATE:
+        await interaction.followup.send(
+            f"❌ Битрейт должен быть от {MIN_OPUS_BITRATE} до {MAX_OPUS_BITRATE} кбит/с.",
+            ephemeral=True)
+        return
+    guild_bitrates[guild_id] = kbps
+    await interaction.followup.send(
+        f"🎚️ Битрейт: **{kbps} кбит/с**. Применится при следующем запуске или переключении станции.",
+        ephemeral=True)
+
+@bot.tree.command(name="streamstats", description="Показать провалы буфера и переподключения по станциям")
+async def stream_stats(interaction: discord.Interaction):
+    await interaction.response.defer()
+    items = [(name, stats) for name, stats in station_stats.items() if stats["underruns"] or stats["reconnects"]]
+    if not items:
+        await interaction.followup.send("Провалов и переподключений не было.", ephemeral=True)
+        return
+    lines = [f"- `{name}`: провалов буфера {stats['underruns']}, переподключений {stats['reconnects']}" for name, stats in items]
+    await interaction.followup.send("**Стабильность потоков:**\n" + "\n".join(lines), ephemeral=True)
+
 @bot.tree.command(name="stations", description="Показать все доступные станции Radio Record")
 async def list_stations(interaction: discord.Interaction):
     await interaction.response.defer()
@@ -697,4 +947,5 @@ async def track_history(interaction: discord.Interaction):
     msg = f"**История треков для `{station_name}` (последние {len(last_items)}):**\n" + "\n".join(lines)
     await interaction.followup.send(msg, ephemeral=False)
 
-bot.run(DISCORD_TOKEN)
\ No newline at end of file
+if __name__ == "__main__":
+    bot.run(DISCORD_TOKEN)
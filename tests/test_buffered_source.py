@@ -0,0 +1,221 @@
+import threading
+import time
+
+import discord
+import pytest
+
+import main
+
+FRAME = b"frame"
+
+
+class FakeProcess:
+    def __init__(self):
+        self.killed = threading.Event()
+
+    def kill(self):
+        self.killed.set()
+
+
+class FakeSource(discord.AudioSource):
+    """Stand-in for an ffmpeg source: optional startup delay, then frames, then EOF or a hang."""
+
+    def __init__(self, frames=0, startup=0.0, hang=False, frame_delay=0.005):
+        self._process = FakeProcess()
+        self.frames = frames
+        self.startup = startup
+        self.hang = hang
+        self.frame_delay = frame_delay
+        self.cleanups = 0
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        if self.startup:
+            if self._process.killed.wait(self.startup):
+                return b""
+            self.startup = 0.0
+        if self._process.killed.is_set():
+            return b""
+        if self.frames:
+            self.frames -= 1
+            time.sleep(self.frame_delay)
+            return FRAME
+        if self.hang:
+            self._process.killed.wait()
+        return b""
+
+    def cleanup(self):
+        self.cleanups += 1
+
+
+class Factory:
+    def __init__(self, *sources):
+        self.sources = list(sources)
+        self.created = []
+
+    def __call__(self):
+        source = self.sources.pop(0) if self.sources else FakeSource()
+        self.created.append(source)
+        return source
+
+
+@pytest.fixture(autouse=True)
+def fast_timeouts(monkeypatch):
+    monkeypatch.setattr(main, "UPSTREAM_CONNECT_GRACE_SECONDS", 0.2)
+    monkeypatch.setattr(main, "MAX_SILENCE_SECONDS", 1.0)
+    monkeypatch.setattr(main, "RECONNECT_MIN_DELAY_SECONDS", 0.1)
+
+
+def make_source(factory, buffer_ms=100):
+    stats = {"underruns": 0, "reconnects": 0}
+    source = main.BufferedRadioSource(factory, stats, buffer_ms=buffer_ms, name="test")
+    return source, stats
+
+
+def play(source, seconds):
+    frames = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frames.append(source.read())
+        time.sleep(main.FRAME_MS / 1000)
+    return frames
+
+
+def test_fills_with_silence_until_buffered_then_plays():
+    factory = Factory(FakeSource(frames=200, frame_delay=0.01))
+    source, stats = make_source(factory)
+    try:
+        frames = play(source, 0.5)
+    finally:
+        source.cleanup()
+    assert frames[0] == main.OPUS_SILENCE_FRAME
+    assert FRAME in frames
+    first_real = frames.index(FRAME)
+    assert all(frame == main.OPUS_SILENCE_FRAME for frame in frames[:first_real])
+    assert stats["underruns"] == 0
+
+
+def test_underrun_is_counted_and_filled_with_silence():
+    # Источник отдаёт кадры медленнее реального времени — буфер опустошается
+    factory = Factory(FakeSource(frames=200, frame_delay=0.03))
+    source, stats = make_source(factory)
+    try:
+        frames = play(source, 1.0)
+    finally:
+        source.cleanup()
+    assert stats["underruns"] >= 1
+    last_real = len(frames) - 1 - frames[::-1].index(FRAME)
+    assert main.OPUS_SILENCE_FRAME in frames[frames.index(FRAME):last_real]
+
+
+def test_backlog_is_trimmed_after_pause():
+    source, _ = make_source(Factory(FakeSource(frames=1000, frame_delay=0.001)))
+    try:
+        play(source, 0.2)
+        # Пауза: discord.py не вызывает read(), а поток чтения продолжает копить кадры
+        time.sleep(0.3)
+        assert len(source._frames) > source._target * 2
+        assert source.read() == FRAME
+        assert len(source._frames) < source._target * 2
+    finally:
+        source.cleanup()
+
+
+def test_reconnects_after_stall_to_slow_starting_upstream():
+    stalled = FakeSource(frames=10, hang=True)
+    factory = Factory(stalled, *(FakeSource(frames=1000, startup=0.15) for _ in range(10)))
+    source, stats = make_source(factory)
+    try:
+        frames = play(source, 1.5)
+    finally:
+        source.cleanup()
+    assert stalled._process.killed.is_set()
+    # Новый источник не убивается, пока подключается
+    assert len(factory.created) == 2
+    assert stats["reconnects"] == 1
+    assert frames[-10:] == [FRAME] * 10
+
+
+def test_reconnects_while_buffer_still_drains():
+    stalled = FakeSource(frames=40, hang=True)
+    factory = Factory(stalled, FakeSource(frames=1000, startup=0.05))
+    source, stats = make_source(factory, buffer_ms=500)
+    try:
+        frames = play(source, 1.5)
+    finally:
+        source.cleanup()
+    assert stalled._process.killed.is_set()
+    assert stats["reconnects"] == 1
+    # Переподключение успело до опустошения буфера — тишины после старта нет
+    assert stats["underruns"] == 0
+    assert all(frame == FRAME for frame in frames[frames.index(FRAME):])
+
+
+def test_short_bursts_back_off_between_reconnects():
+    factory = Factory(*(FakeSource(frames=2) for _ in range(100)))
+    source, stats = make_source(factory)
+    try:
+        play(source, 1.0)
+    finally:
+        source.cleanup()
+    # Паузы 0.1, 0.2, 0.4 с — за секунду не больше четырёх переподключений
+    assert 1 <= stats["reconnects"] <= 4
+
+
+def test_upstream_lost_after_max_silence():
+    def failing_factory():
+        raise RuntimeError("ffmpeg not found")
+
+    first = FakeSource(frames=10)
+    calls = []
+
+    def factory():
+        calls.append(1)
+        if len(calls) == 1:
+            return first
+        return failing_factory()
+
+    source, stats = make_source(factory)
+    try:
+        with pytest.raises(main.UpstreamLost, match="ffmpeg not found"):
+            play(source, 3.0)
+    finally:
+        source.cleanup()
+    assert stats["reconnects"] == 1
+
+
+def test_cleanup_after_failed_factory():
+    def factory():
+        raise RuntimeError("ffmpeg not found")
+
+    # Так же cleanup() вызывает AudioSource.__del__ для недостроенного объекта
+    source = main.BufferedRadioSource.__new__(main.BufferedRadioSource)
+    with pytest.raises(RuntimeError):
+        source.__init__(factory, {"underruns": 0, "reconnects": 0})
+    source.cleanup()
+
+
+def test_upstream_cleaned_up_only_by_reader_thread():
+    stalled = FakeSource(frames=10, hang=True)
+    replacement = FakeSource(frames=1000)
+    factory = Factory(stalled, replacement)
+    source, _ = make_source(factory)
+    play(source, 0.8)
+    source.cleanup()
+    assert stalled.cleanups == 1
+    assert replacement.cleanups == 1
+    assert replacement._process.killed.is_set()
+
+
+def test_unplayed_source_starts_no_reader_and_cleans_upstream():
+    upstream = FakeSource(frames=1000)
+    source, stats = make_source(Factory(upstream))
+    assert not any(thread.name == "radio-buffer" for thread in threading.enumerate())
+    source.cleanup()
+    assert upstream.cleanups == 1
+    # После cleanup() read() уже не запускает поток чтения
+    source.read()
+    assert not any(thread.name == "radio-buffer" for thread in threading.enumerate())
+    assert stats["reconnects"] == 0